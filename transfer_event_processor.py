@@ -1,13 +1,53 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import sqlite3
+import numpy as np
 import pandas as pd
-from datetime import datetime
-from web3 import Web3
+import requests
+from eth_utils import to_checksum_address
+from web3 import AsyncHTTPProvider, AsyncWeb3, Web3
 import time as tt
 
+# # numba is optional, without it calculate_running_balances sticks to the vectorized groupby path
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 INPUT_CSV_FILENAME = 'iusd_transfers.csv'
 OUTPUT_CSV_FILENAME = 'processed_iusd_transfers.csv'
 VELO_VOLATILE_CSV_FILENAME = 'velo_volatile_mint_burn_events.csv'
 
-CUTOFF_DATE = '03-17-2025'
+# # our wallet_type cache, a sqlite table keyed on address
+LABELS_DB_FILENAME = 'existing_labels.db'
+
+# # the old csv cache, only read to seed an empty labels table
+OLD_LABEL_CACHE_FILENAME = 'existing_labels.csv'
+
+# # the only columns the pipeline reads, block_number is never used so it isn't parsed at all
+INPUT_CSV_DTYPES = {
+                    'timestamp': 'float64',
+                    'tx_hash': 'string',
+                    'from_address': 'string',
+                    'to_address': 'string',
+                    'amount': 'float64'
+                    }
+
+# # same idea for the mint/burn csvs, block_number and sender_address aren't used
+VELO_CSV_DTYPES = {
+                    'timestamp': 'float64',
+                    'tx_hash': 'string',
+                    'to_address': 'string',
+                    'amount0': 'float64',
+                    'amount1': 'float64',
+                    'event_type': 'string'
+                    }
+
+CUTOFF_DATE = '2025-03-17'
+
+# # first second after the cutoff day (utc), so the cutoff can be applied straight to the raw timestamp column
+CUTOFF_TIMESTAMP = (pd.Timestamp(CUTOFF_DATE, tz='UTC') + pd.Timedelta(days=1)).timestamp()
 
 LP_CONTRACT_ADDRESS_LIST = [# '0x2815bF2bDd198E6d09B9F02Ef6D62281b2FaAdB7', 
                             '0x0f53E9d4147c2073cc64a70FFc0fec9606E2EEb7', 
@@ -21,28 +61,42 @@ LP_CSV_NAME_LIST = [
                     'kim_cl_mint_burn_events.csv'
                     ]
 
-w3 = Web3(Web3.HTTPProvider('https://mainnet.mode.network'))
+RPC_URL = 'https://mainnet.mode.network'
+
+w3 = Web3(Web3.HTTPProvider(RPC_URL))
 
 WAIT_TIME = 0.5
 
-# Makes our nice mm-dd-yyyy day column
+# # how many eth_getCode calls go into one json-rpc batch
+RPC_BATCH_SIZE = 500
+
+# # how many times a batch that failed for something other than its size gets resent before we give up on batching
+RPC_MAX_RETRIES = 3
+
+# # how many eth_getCode calls can be in flight at once when the rpc won't take batches
+RPC_CONCURRENCY = 25
+
+# Makes our nice yyyy-mm-dd day column (sorts the same as a string and as a date, so the cutoff compare works across years)
 def make_day_column(df):
     # Create 'day' column while preserving the original timestamp
-    df['day'] = df['timestamp'].apply(lambda x: datetime.fromtimestamp(x).strftime('%m-%d-%Y'))
+    df['day'] = pd.to_datetime(df['timestamp'], unit='s', utc=True).dt.strftime('%Y-%m-%d')
     return df
 
-# # returns a dataframe with only activity before the cutoff day
+# # returns a dataframe with only activity up to and including the cutoff day
+# # only needs the timestamp column, so it can run before any day formatting or balance math
 def get_cutoff_day_df(df):
-    df = df.loc[df['day'] <= CUTOFF_DATE]
+    df = df.loc[df['timestamp'].to_numpy() < CUTOFF_TIMESTAMP]
 
     return df
 
 # # will return a dataframe that only contains token transfers that occur on the same tx hashes as our adding or removing liquidity from lps
 def match_transaction_hashes_df(transfer_df, lp_df):
 
-    unique_lp_tx_hash_list = lp_df['tx_hash'].unique()
+    # # will build a set of the lp tx hashes for the isin lookup
+    # # lowercased to match the transfer tx_hash column, which run_all lowercases on load
+    lp_tx_hash_set = frozenset(lp_df['tx_hash'].str.lower())
 
-    shared_tx_hash_df = transfer_df.loc[transfer_df['tx_hash'].isin(unique_lp_tx_hash_list)]
+    shared_tx_hash_df = transfer_df.loc[transfer_df['tx_hash'].isin(lp_tx_hash_set)]
 
     return shared_tx_hash_df
 
@@ -51,152 +105,196 @@ def filter_to_lp_transfers(df, lp_address):
 
     lp_address = lp_address.lower()
 
-    df_list = []
-
-    temp_df = df.loc[df['from_address'] == lp_address]
-    df_list.append(temp_df)
-    temp_df = df.loc[df['to_address'] == lp_address]
-    df_list.append(temp_df)
-
-    df = pd.concat(df_list)
+    # # will keep any transfer where the lp is the sender or the receiver, a transfer from the lp to itself is kept once
+    mask = (df['from_address'].values == lp_address) | (df['to_address'].values == lp_address)
+    df = df.loc[mask]
 
     return df
 
 # # gets the most recent user balance
 def get_last_user_balance(df):
 
-    unique_user_list = df['address'].unique()
-
-    df_list = []
-
-    # # filters dataframe down to subset of just each user, then down to each user's last transaction, then adds the 1 row df to df_list to later be combined with other users last event
-    for unique_user in unique_user_list:
-        temp_df = df.loc[df['address'] == unique_user]
-        last_timestamp = temp_df['timestamp'].max()
-
-        temp_df = temp_df.loc[temp_df['timestamp'] == last_timestamp]
-        max_balance = temp_df['balance'].astype(float).max()
-        
-        temp_df = temp_df.loc[temp_df['balance'].astype(float) == max_balance]
-
-        df_list.append(temp_df)
-    
-    try:
-        df = pd.concat(df_list)
-    except:
-        print(df)
-        print(unique_user_list)
-
-    df['last_balance'] = df['balance']
+    # # 'balance' is a cumsum in the frame's current row order, so each user's last row already holds their final balance
+    # # will keep that row per user, so same-timestamp events can't pick an intermediate balance over the final one
+    df = df.groupby('address', sort=False).tail(1)
 
-    df = df[['address', 'last_balance']]
-    df['last_balance'] /= 1e18
+    # # cast after the tail so only one row per user is converted, and it's a no-op for the float64 balances run_all produces
+    df = df[['address', 'balance']].rename(columns={'balance': 'last_balance'}).astype({'last_balance': 'float64'})
 
     return df
 
 # # will estimate the balances of users
 def get_rolling_balance(df, lp_address):
-    
-    df_list = []
 
     if len(lp_address) > 0:
         lp_address = lp_address.lower()
 
-        mint_df = df.loc[df['to_address'] == lp_address]
-        mint_df['address'] = mint_df['to_address']
-
-        burn_df = df.loc[df['from_address'] == lp_address]
-        burn_df['address'] = burn_df['from_address']
+        # # +1 for mints into the lp, -1 for burns out of it, 0 for an lp-to-itself transfer (which always netted to zero)
+        sign = (df['to_address'] == lp_address).to_numpy(dtype=np.float64) - (df['from_address'] == lp_address).to_numpy(dtype=np.float64)
+        touches_lp = sign != 0
 
-        burn_df['amount'] = burn_df['amount'] * -1
-
-        df_list.append(mint_df)
-        df_list.append(burn_df)
+        # # will keep just the lp's transfers, signed, with the lp as the address
+        df = df.loc[touches_lp].assign(address=lp_address, amount=df['amount'].to_numpy()[touches_lp] * sign[touches_lp])
     
     else:
-        from_df = df.copy()
-        from_df['address'] = df['from_address']
-        from_df['amount'] = from_df['amount'] * -1
-
-        df['address'] = df['to_address']
-
-        df_list.append(from_df)
-        df_list.append(df)
-
+        # # a debit row for the sender and a credit row for the receiver, assign leaves the caller's frame alone and shares untouched columns
+        df = pd.concat([
+            df.assign(address=df['from_address'], amount=-df['amount']),
+            df.assign(address=df['to_address'])
+        ])
 
-    df = pd.concat(df_list)
     df = df.sort_values(by='timestamp', ascending=True)
 
     df['balance'] = df.groupby('address')['amount'].cumsum()
 
     return df
 
+# # Returns True if the bytecode belongs to a contract. Returns False if it is an EOA
+def is_contract_code(code):
+    # If the bytecode is empty (just '0x'), it's an EOA
+    # If it contains code, it's a contract
+    return code != '0x' and code != b'0x' and code != b'' and code != ''
+
 # # Returns True if it is a contract. Returns False if it is an EOA
 def is_contract(address, w3):
     # Get the bytecode at the address
     code = w3.eth.get_code(address)
-    
-    # If the bytecode is empty (just '0x'), it's an EOA
-    # If it contains code, it's a contract
-    return code != '0x' and code != b'0x' and code != b'' and code != ''
 
-# # will label our df addresses on whether they are contracts or not
-def label_contracts(df, w3):
+    return is_contract_code(code)
 
-    unique_address_list = df['address'].unique()
-    
-    wallet_type_list = []
+# # will label addresses as 'contract' or 'eoa', sending their eth_getCode calls as json-rpc batches
+def get_wallet_types_batched(address_list, w3, wallet_type_dict=None):
 
-    try:
-        existing_label_df = pd.read_csv('existing_labels.csv')
-    except:
-        existing_label_df = pd.DataFrame()
+    # # filled in place, so a caller passing its own dict keeps every label resolved before an error
+    if wallet_type_dict is None:
+        wallet_type_dict = {}
 
     i = 0
+    batch_size = RPC_BATCH_SIZE
+    retry_count = 0
 
-    while i < len(unique_address_list):
-        wallet_type = ''
-        is_address_contract = False
-        unique_address_og = unique_address_list[i]
+    while i < len(address_list):
+        address_batch = address_list[i:i + batch_size]
 
-        unique_address = w3.to_checksum_address(unique_address_og)
+        try:
+            with w3.batch_requests() as batch:
+                # # will checksum with eth_utils right before each address's rpc call
+                for checksum_address in map(to_checksum_address, address_batch):
+                    batch.add(w3.eth.get_code(checksum_address))
 
-        # # logic so we don't have to see what wallet_type someone is if we have previously labeled it
-        if len(existing_label_df) > 0:
-            temp_df = existing_label_df.loc[existing_label_df['address'] == unique_address_og.lower()]
+                code_list = batch.execute()
 
-            if len(temp_df) > 0:
-                wallet_type = temp_df['wallet_type'].tolist()[0]
-        
-        if len(wallet_type) < 1:
-            is_address_contract = is_contract(unique_address, w3)
-            print('Wallet Checked: ', unique_address)
-            tt.sleep(WAIT_TIME)
-        # # end already_exists checking logic
+        except Exception as e:
+            # # a 413 means the rpc caps batch size below what we sent, so halve what was actually sent and keep that size from here on
+            if isinstance(e, requests.HTTPError) and e.response is not None and e.response.status_code == 413 and len(address_batch) > 1:
+                batch_size = len(address_batch) // 2
+                print('Batch too large, retrying with batch size: ', batch_size)
+                continue
+
+            # # anything else (rate limits, timeouts) gets the same batch resent after a backoff, and goes to the caller once we're out of retries
+            retry_count += 1
+            if retry_count > RPC_MAX_RETRIES:
+                raise
+
+            print('Batch failed, retrying in ', WAIT_TIME * retry_count, ' seconds: ', e)
+            tt.sleep(WAIT_TIME * retry_count)
+            continue
 
-            if is_address_contract == True:
-                wallet_type = 'contract'
+        retry_count = 0
+
+        for address, code in zip(address_batch, code_list):
+            if is_contract_code(code) == True:
+                wallet_type_dict[address] = 'contract'
             
             else:
-                wallet_type = 'eoa'
-        
-        wallet_type_list.append(wallet_type)
+                wallet_type_dict[address] = 'eoa'
+
+        i += len(address_batch)
+        print('Wallets Checked: ', i, '/', len(address_list))
+
+        # # will pause between batches so we stay polite to the public rpc
+        if i < len(address_list):
+            tt.sleep(WAIT_TIME)
+
+    return wallet_type_dict
+
+# # same labels for rpcs that don't take batches: single eth_getCode calls overlapped, the semaphore caps how many are in flight
+async def get_wallet_types_concurrent(address_list, rpc_url=RPC_URL):
+
+    async_w3 = AsyncWeb3(AsyncHTTPProvider(rpc_url))
+    semaphore = asyncio.Semaphore(RPC_CONCURRENCY)
 
-        i += 1
-        # print('Addresses Checked: ', i, '/',len(unique_address_list))
+    async def get_wallet_type(address):
+        async with semaphore:
+            code = await async_w3.eth.get_code(to_checksum_address(address))
 
+        if is_contract_code(code) == True:
+            return address, 'contract'
+
+        return address, 'eoa'
+
+    wallet_type_list = await asyncio.gather(*(get_wallet_type(address) for address in address_list))
+
+    return dict(wallet_type_list)
+
+# # runs a coroutine to completion from sync code, even when an event loop is already running on this thread (jupyter or another async host)
+def _run_coroutine(coroutine):
     try:
-        df['wallet_type'] = wallet_type_list
-    except:
-        df = df.drop_duplicates(subset=['address', 'last_balance'])
-        df['wallet_type'] = wallet_type_list
-    
-    df = df.drop_duplicates(subset=['address', 'wallet_type'])
-    df['address'] = df['address'].astype(str).str.lower()
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    # # asyncio.run can't be called from a running loop, so the coroutine gets its own loop on a worker thread
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+# # will label our df addresses on whether they are contracts or not
+def label_contracts(df, w3):
+
+    df = df.assign(address=df['address'].astype(str).str.lower())
+
+    # # closing() so the connection is released even if an rpc lookup below raises
+    with contextlib.closing(sqlite3.connect(LABELS_DB_FILENAME)) as connection:
+        connection.execute('CREATE TABLE IF NOT EXISTS labels (address TEXT PRIMARY KEY, wallet_type TEXT)')
+
+        # # address -> wallet_type for everyone we've labeled before
+        known_labels = dict(connection.execute('SELECT address, wallet_type FROM labels').fetchall())
+
+        # # first run on sqlite, carry over whatever the old csv cache had
+        if len(known_labels) == 0:
+            try:
+                existing_label_df = pd.read_csv(OLD_LABEL_CACHE_FILENAME)
+            except:
+                existing_label_df = pd.DataFrame()
+
+            if len(existing_label_df) > 0:
+                known_labels = dict(zip(existing_label_df['address'].astype(str).str.lower(), existing_label_df['wallet_type']))
+                connection.executemany('INSERT OR REPLACE INTO labels VALUES (?, ?)', known_labels.items())
+                connection.commit()
+
+        unknown_address_list = [address for address in df['address'].unique() if address not in known_labels]
+
+        new_label_dict = {}
 
-    df_list = [existing_label_df, df]
-    existing_label_df = pd.concat(df_list)
-    existing_label_df.to_csv('existing_labels.csv', index=False)
+        # # batches first, and if the rpc rejects those, concurrent single calls
+        try:
+            try:
+                get_wallet_types_batched(unknown_address_list, w3, new_label_dict)
+            except Exception as e:
+                print('Batch eth_getCode failed, falling back to concurrent calls: ', e)
+                # # only the addresses the batches didn't get to, on the same endpoint as the w3 we were handed
+                remaining_address_list = [address for address in unknown_address_list if address not in new_label_dict]
+                new_label_dict.update(_run_coroutine(get_wallet_types_concurrent(remaining_address_list, getattr(w3.provider, 'endpoint_uri', RPC_URL))))
+
+        finally:
+            # # will save whatever got labeled this run, even if the fallback raised, the primary key keeps one row per address
+            connection.executemany('INSERT OR REPLACE INTO labels VALUES (?, ?)', new_label_dict.items())
+            connection.commit()
+
+    known_labels.update(new_label_dict)
+
+    df['wallet_type'] = df['address'].map(known_labels)
+    df = df.drop_duplicates(subset=['address', 'wallet_type'])
 
     return df
 
@@ -241,6 +339,17 @@ def get_user_share_of_contract_balance(original_transfer_df, labeled_df, w3, max
     
     # Track which contracts we've processed
     processed_contracts = set()
+
+    # # the attribution only needs who, how much and which counterparty, so every transfer is emitted once per side up front
+    # # withdrawals (transfers FROM a contract) count against the recipient, deposits (transfers TO a contract) count for the sender
+    withdrawal_df = original_transfer_df[['to_address', 'from_address', 'amount']].rename(columns={'to_address': 'address', 'from_address': 'counterparty'})
+    withdrawal_df = withdrawal_df.assign(amount=-withdrawal_df['amount'])
+    deposit_df = original_transfer_df[['from_address', 'to_address', 'amount']].rename(columns={'from_address': 'address', 'to_address': 'counterparty'})
+    long_transfer_df = pd.concat([withdrawal_df, deposit_df], ignore_index=True)
+
+    # # addresses added during attribution are never in result_df so they all come in as eoas, which means the contracts are known up front and every other counterparty can go now
+    contract_set = frozenset(result_df.loc[result_df['wallet_type'] == 'contract', 'address'])
+    long_transfer_df = long_transfer_df.loc[long_transfer_df['counterparty'].isin(contract_set)]
     
     # Process contracts iteratively to handle contract-to-contract interactions
     for iteration in range(max_iterations):
@@ -258,125 +367,65 @@ def get_user_share_of_contract_balance(original_transfer_df, labeled_df, w3, max
             print(f"No more unprocessed contracts at iteration {iteration+1}")
             break
         
-        # Store attribution data for this iteration
-        iteration_data = []
-        
-        # Process each contract
-        for contract_address in contract_addresses:
-            # Get contract's current balance
-            contract_row = result_df.loc[result_df['address'] == contract_address]
-            if contract_row.empty:
-                continue
-                
-            contract_balance = contract_row['last_balance'].iloc[0]
-            
-            # Skip if effectively zero balance
-            if abs(contract_balance) < 1e-10:
-                processed_contracts.add(contract_address)
-                continue
-            
-            # Get withdrawals (transfers FROM the contract)
-            withdrawals = original_transfer_df.loc[
-                original_transfer_df['from_address'] == contract_address
-            ].copy()
-            withdrawals['amount'] = -withdrawals['amount']  # Mark as negative
-            withdrawals['address'] = withdrawals['to_address']  # Track recipient
-            
-            # Get deposits (transfers TO the contract)
-            deposits = original_transfer_df.loc[
-                original_transfer_df['to_address'] == contract_address
-            ].copy()
-            deposits['address'] = deposits['from_address']  # Track sender
-            
-            # Combine transfers and sort chronologically
-            contract_transfers = pd.concat([withdrawals, deposits])
-            contract_transfers = contract_transfers.sort_values(by='timestamp')
-            
-            # Skip if no transactions
-            if len(contract_transfers) == 0:
-                processed_contracts.add(contract_address)
-                continue
-            
-            # Calculate running balance per address
-            contract_transfers['balance'] = contract_transfers.groupby('address')['amount'].cumsum()
-            
-            # Get latest balance for each address
-            latest_balances = contract_transfers.groupby('address')['balance'].last().reset_index()
-            
-            # Label addresses as EOA or contract
-            latest_balances = latest_balances.merge(
-                result_df[['address', 'wallet_type']], 
-                on='address', 
-                how='left'
-            )
-            
-            # Default to EOA for any addresses not in our labeled_df
-            latest_balances['wallet_type'] = latest_balances['wallet_type'].fillna('eoa')
-            
-            # Calculate total positive contribution
-            total_positive = latest_balances.loc[latest_balances['balance'] > 0, 'balance'].sum()
-            
-            # Skip if no positive balances
-            if total_positive <= 0:
-                processed_contracts.add(contract_address)
-                continue
-            
-            # Attribute contract balance proportionally to addresses with positive balances
-            for _, row in latest_balances.iterrows():
-                address = row['address']
-                balance = row['balance']
-                wallet_type = row['wallet_type']
-                
-                # Only attribute to addresses with positive contributions
-                if balance <= 0:
-                    continue
-                
-                # Calculate proportional share of the contract's balance
-                attributed_share = (balance / total_positive) * contract_balance
-                
-                iteration_data.append({
-                    'address': address,
-                    'attributed_balance': attributed_share,
-                    'source_contract': contract_address,
-                    'wallet_type': wallet_type
-                })
-            
-            # Mark as processed
-            processed_contracts.add(contract_address)
+        # Get each contract's current balance
+        contract_balances = contract_df.drop_duplicates(subset='address').set_index('address')['last_balance']
+
+        # # every contract looked at this iteration is done, whether or not it ends up attributing anything
+        processed_contracts.update(contract_addresses)
+
+        # Skip if effectively zero balance
+        contract_balances = contract_balances.loc[contract_balances.abs() >= 1e-10]
         
-        # Convert iteration data to DataFrame
-        if len(iteration_data) == 0:
+        # # will grab every transfer with this iteration's non-zero contracts in one mask over the long frame
+        contract_transfers = long_transfer_df.loc[long_transfer_df['counterparty'].isin(frozenset(contract_balances.index))]
+
+        # Get latest balance for each address with each contract
+        # # will sum each address's transfers with each contract, which is the last value its running balance would reach
+        latest_balances = contract_transfers.groupby(['counterparty', 'address'], sort=False, observed=True, as_index=False)['amount'].sum().rename(columns={'amount': 'balance'})
+
+        # Only attribute to addresses with positive contributions
+        contributors = latest_balances.loc[latest_balances['balance'] > 0]
+        contributors = contributors.assign(counterparty=contributors['counterparty'].astype(str), address=contributors['address'].astype(str))
+
+        if len(contributors) == 0:
             print(f"No attributions in iteration {iteration+1}")
             break
-            
-        iteration_df = pd.DataFrame(iteration_data)
+
+        # Calculate total positive contribution per contract
+        total_positive = contributors.groupby('counterparty', sort=False)['balance'].transform('sum')
+
+        # Label addresses as EOA or contract, defaulting to EOA for any addresses not in our labeled_df
+        wallet_type_map = result_df.drop_duplicates(subset='address').set_index('address')['wallet_type']
+
+        # Calculate proportional share of each contract's balance
+        iteration_df = pd.DataFrame({
+            'address': contributors['address'],
+            'attributed_balance': (contributors['balance'] / total_positive) * contributors['counterparty'].map(contract_balances),
+            'source_contract': contributors['counterparty'],
+            'wallet_type': contributors['address'].map(wallet_type_map).fillna('eoa')
+        })
         
         # Group by address to sum attributions from different contracts
-        address_attributions = iteration_df.groupby(['address', 'wallet_type'])['attributed_balance'].sum().reset_index()
+        address_attributions = iteration_df.groupby('address', sort=False)['attributed_balance'].sum()
         
         # Update result DataFrame
-        for _, row in address_attributions.iterrows():
-            address = row['address']
-            wallet_type = row['wallet_type']
-            attributed_balance = row['attributed_balance']
-            
-            # If address exists, update its attributed balance
-            if address in result_df['address'].values:
-                idx = result_df.loc[result_df['address'] == address].index[0]
-                result_df.at[idx, 'attributed_balance'] += attributed_balance
-                
-                # If this is a contract we just processed, zero its balance
-                if address in processed_contracts:
-                    result_df.at[idx, 'last_balance'] = 0
-            else:
-                # Add new row for addresses not in original DataFrame
-                new_row = pd.DataFrame({
-                    'address': [address],
-                    'last_balance': [0],
-                    'attributed_balance': [attributed_balance],
-                    'wallet_type': [wallet_type]
-                })
-                result_df = pd.concat([result_df, new_row], ignore_index=True)
+        # # will add this iteration's attributions to every address we already have
+        result_df['attributed_balance'] += result_df['address'].map(address_attributions).fillna(0)
+
+        # If this is a contract we just processed, zero its balance
+        result_df.loc[result_df['address'].isin(address_attributions.index) & result_df['address'].isin(processed_contracts), 'last_balance'] = 0
+
+        # Add new rows for addresses not in original DataFrame, all in one concat
+        new_address_index = address_attributions.index.difference(result_df['address'])
+
+        if len(new_address_index) > 0:
+            new_rows = pd.DataFrame({
+                'address': new_address_index,
+                'last_balance': 0,
+                'attributed_balance': address_attributions[new_address_index].values,
+                'wallet_type': 'eoa'
+            })
+            result_df = pd.concat([result_df, new_rows], ignore_index=True)
     
     # Calculate total balance (original + attributed)
     result_df['total_balance'] = result_df['last_balance'] + result_df['attributed_balance']
@@ -397,58 +446,90 @@ def get_share_of_lp(lp_df):
     # # just sums the non-zero balances together to estimate how much iUSD there was
     pool_total_token = lp_df['last_balance'].sum()
 
-    lp_df['percentage_of_lp'] = lp_df['last_balance'] / pool_total_token
-    lp_df['token_equivalent_of_lp'] = lp_df['percentage_of_lp'] * pool_total_token
+    # # will add each user's share of the pool and their token equivalent
+    lp_df = lp_df.assign(percentage_of_lp=lp_df['last_balance'] / pool_total_token)
+    lp_df = lp_df.assign(token_equivalent_of_lp=lp_df['percentage_of_lp'] * pool_total_token)
 
     print('Total Token in Pool: ', pool_total_token)
 
     return lp_df
 
+# # one pass over the transfers in order, balances live in an array indexed by address code
+def _running_balances_kernel(from_codes, to_codes, amounts, address_count):
+    balances = np.zeros(address_count, np.float64)
+    from_balance_after = np.empty(len(amounts), np.float64)
+    to_balance_after = np.empty(len(amounts), np.float64)
+
+    for i in range(len(amounts)):
+        balances[from_codes[i]] -= amounts[i]
+        balances[to_codes[i]] += amounts[i]
+
+        from_balance_after[i] = balances[from_codes[i]]
+        to_balance_after[i] = balances[to_codes[i]]
+
+    return from_balance_after, to_balance_after
+
+if njit is not None:
+    _running_balances_kernel = njit(cache=True)(_running_balances_kernel)
+
 # Track running balances for all addresses
 def calculate_running_balances(df):
     # Sort by timestamp to ensure chronological processing
     df = df.sort_values('timestamp').reset_index(drop=True)
-    
-    # Get all unique addresses from both from_address and to_address
-    from_addresses = set(df['from_address'])
-    to_addresses = set(df['to_address'])
-    all_addresses = from_addresses.union(to_addresses)
-    
-    # Initialize balances for all addresses
-    balances = {addr: 0 for addr in all_addresses}
-    
-    # Create columns to store running balances
-    df['from_balance_after'] = 0.0
-    df['to_balance_after'] = 0.0
-    
-    # Process each transaction
-    for idx, row in df.iterrows():
-        from_addr = row['from_address']
-        to_addr = row['to_address']
-        amount = row['amount']
-        
-        # Deduct from sender
-        balances[from_addr] -= amount
-        
-        # Add to receiver
-        balances[to_addr] += amount
-        
-        # Store the updated balances
-        df.at[idx, 'from_balance_after'] = balances[from_addr]
-        df.at[idx, 'to_balance_after'] = balances[to_addr]
-    
+
+    # # with numba: integer-code both address columns against one shared index and run the compiled loop
+    if njit is not None:
+        address_dtype = df['from_address'].dtype
+
+        # # run_all's shared categorical already is that index, otherwise factorize both columns together
+        if isinstance(address_dtype, pd.CategoricalDtype) and address_dtype == df['to_address'].dtype:
+            from_codes = df['from_address'].cat.codes.to_numpy()
+            to_codes = df['to_address'].cat.codes.to_numpy()
+            address_count = len(address_dtype.categories)
+        else:
+            codes, unique_addresses = pd.factorize(pd.concat([df['from_address'], df['to_address']], ignore_index=True))
+            from_codes = codes[:len(df)]
+            to_codes = codes[len(df):]
+            address_count = len(unique_addresses)
+
+        from_balance_after, to_balance_after = _running_balances_kernel(
+            from_codes, to_codes, df['amount'].to_numpy(dtype=np.float64), address_count
+        )
+
+        df['from_balance_after'] = from_balance_after
+        df['to_balance_after'] = to_balance_after
+
+        return df
+
+    # # one signed flow per side of each transfer, tagged with the row it came from and which side it is
+    sent = df[['from_address']].rename(columns={'from_address': 'address'}).assign(delta=-df['amount'], side=0)
+    recv = df[['to_address']].rename(columns={'to_address': 'address'}).assign(delta=df['amount'], side=1)
+
+    # # the sender is debited before the receiver is credited, same as processing the rows one at a time
+    flows = pd.concat([sent, recv]).rename_axis('row').sort_values(['row', 'side'])
+    flows['balance'] = flows.groupby('address', sort=False)['delta'].cumsum()
+
+    # Store the updated balances
+    df['from_balance_after'] = flows.loc[flows['side'] == 0, 'balance']
+    df['to_balance_after'] = flows.loc[flows['side'] == 1, 'balance']
+
+    # # a transfer to yourself leaves both sides at the balance after the credit
+    self_transfer = df['from_address'] == df['to_address']
+    df.loc[self_transfer, 'from_balance_after'] = df.loc[self_transfer, 'to_balance_after']
+
     return df
 
 # # our regular volatile swap pool processing
 def get_user_velo_volatile_lp_balance():
-    df = pd.read_csv(VELO_VOLATILE_CSV_FILENAME)
+    df = pd.read_csv(VELO_VOLATILE_CSV_FILENAME, engine='pyarrow', usecols=list(VELO_CSV_DTYPES), dtype=VELO_CSV_DTYPES)
 
     df['address'] = df['to_address']
-    
-    df[['timestamp', 'amount0', 'amount1']] = df[['timestamp','amount0', 'amount1']].astype(float)
 
-    df['amount0'] /= 1e18
-    df['amount1'] /= 1e6
+    # # drop post-cutoff events up front, the running balance of the events we keep doesn't depend on later ones
+    df = get_cutoff_day_df(df)
+
+    # # will scale the raw amounts to token units
+    df = df.assign(amount0=df['amount0'] / 1e18, amount1=df['amount1'] / 1e6)
 
     # # would get total inputs and outputs for both tokens in pair
     # df['amount'] = df['amount0'] + df['amount1']
@@ -458,25 +539,41 @@ def get_user_velo_volatile_lp_balance():
 
     df = df.sort_values('timestamp', ascending=True)
 
-    df.loc[df['event_type'] == 'burn', 'amount'] = df['amount'] * -1
+    # # will flip the sign on burns so they count against the user
+    sign = np.where(df['event_type'].to_numpy() == 'burn', -1.0, 1.0)
+    df['amount'] = df['amount'].to_numpy() * sign
     # Group by address and calculate cumulative sum within each group
     df['balance'] = df.groupby('address')['amount'].cumsum()
 
-    df = make_day_column(df)
-    df = get_cutoff_day_df(df)
     df = get_last_user_balance(df)
 
     return df
 
 # Our runner function
 def run_all():
-    df = pd.read_csv(INPUT_CSV_FILENAME)
-    df = df.drop_duplicates(subset=['block_number','timestamp','tx_hash','from_address','to_address','amount'])
-    df[['amount','timestamp']] = df[['amount','timestamp']].astype(float)
+    # # will read just the columns we use, with their types, through the multithreaded pyarrow parser
+    df = pd.read_csv(INPUT_CSV_FILENAME, engine='pyarrow', usecols=list(INPUT_CSV_DTYPES), dtype=INPUT_CSV_DTYPES)
+    # # block_number and timestamp are fixed by the tx_hash, so they add hashing work without changing which rows are duplicates
+    # # there is no log_index in this csv, otherwise (tx_hash, log_index) would be the key
+    df = df.drop_duplicates(subset=['tx_hash','from_address','to_address','amount'], keep='first')
+
+    # # wei -> iUSD once here, everything downstream works in token units
+    df['amount'] /= 1e18
+
+    # # lowercase once, then store addresses as categoricals sharing one set of categories so masks and groupbys compare int codes
+    for column in ['from_address', 'to_address', 'tx_hash']:
+        df[column] = df[column].str.lower()
+
+    # # missing addresses are left out of the categories so they become NaN codes instead of raising
+    address_dtype = pd.CategoricalDtype(pd.concat([df['from_address'], df['to_address']]).dropna().unique())
+    df['from_address'] = df['from_address'].astype(address_dtype)
+    df['to_address'] = df['to_address'].astype(address_dtype)
+    df['tx_hash'] = df['tx_hash'].astype('category')
 
-    df = make_day_column(df)
-    og_df = df.copy()
     # df = get_cutoff_day_df(df)
+    df = make_day_column(df)
+    # # get_rolling_balance never writes into its input, so og_df can share the transfers
+    og_df = df
     
     # i = 2
 
@@ -507,9 +604,11 @@ def run_all():
     return lp_df
 
 # Run everything and print sample results
-df = run_all()
-# df = df.loc[df['address'] == '0x0f53E9d4147c2073cc64a70FFc0fec9606E2EEb7'.lower()]
-print("Transaction data sample:")
-print(df.head())
-print('Long: ', len(df))
-df.to_csv('test_test.csv', index=False)
\ No newline at end of file
+# # only when run as a script, importing this module shouldn't kick off the whole pipeline
+if __name__ == '__main__':
+    df = run_all()
+    # df = df.loc[df['address'] == '0x0f53E9d4147c2073cc64a70FFc0fec9606E2EEb7'.lower()]
+    print("Transaction data sample:")
+    print(df.head())
+    print('Long: ', len(df))
+    df.to_csv('test_test.csv', index=False)
\ No newline at end of file